@@ -2,15 +2,19 @@
 
 import asyncio
 import base64
+import itertools
 import json
 import logging
 import re
+import threading
 import time
-import uuid
 import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import AsyncGenerator, Callable
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 from logging.handlers import TimedRotatingFileHandler
 
@@ -21,6 +25,10 @@ from stats import get_stats
 
 settings = get_settings()
 
+# Settings read on every request, bound once at import
+_MAX_SOURCE_LENGTH = settings.max_source_length
+_QUEUE_TIMEOUT = settings.queue_timeout
+
 # Setup logging with hourly rotation
 logger = logging.getLogger("facto_compiler")
 logger.setLevel(logging.INFO if not settings.debug_mode else logging.DEBUG)
@@ -48,6 +56,27 @@ if settings.debug_mode:
     console_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
     logger.addHandler(console_handler)
 
+# Long-lived worker threads for the in-process compiler. Kept separate from the
+# loop's default executor so compiles never compete with other to_thread work.
+# A compile abandoned by its client keeps its thread after the queue slot is
+# released, so there is one spare thread for the next request to start on.
+_compile_executor = ThreadPoolExecutor(
+    max_workers=settings.max_concurrent_compilations + 1,
+    thread_name_prefix="facto-compile",
+)
+
+# Shared by every compile's log capture handler
+_LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+_CAPTURE_FORMATTER = logging.Formatter("%(levelname)s: %(message)s")
+
+_VALID_POWER_POLES = frozenset({None, "small", "medium", "big", "substation"})
+_UNSAFE_NAME_CHARS_RE = re.compile(r"[^a-zA-Z0-9\s\-_]")
+
 
 class OutputType(str, Enum):
     LOG = "log"
@@ -71,7 +100,16 @@ def json_to_blueprint(json_data: dict | str) -> str:
     return '0' + encoded
 
 
-@dataclass
+def _result_to_blueprint(result: dict | str) -> str:
+    """Convert a compile result (dict or JSON string) to a blueprint string."""
+    if isinstance(result, dict):
+        json_data = result
+    else:
+        json_data = json.loads(result)
+    return json_to_blueprint(json_data)
+
+
+@dataclass(slots=True, frozen=True)
 class CompilerOptions:
     """Options passed to the Facto compiler."""
 
@@ -80,22 +118,21 @@ class CompilerOptions:
     no_optimize: bool = False
     json_output: bool = False
     log_level: str = "info"  # debug, info, warning, error
+    stream_logs: bool = True  # False: hand over all logs once compilation ends
 
     def __post_init__(self):
         """Validate and sanitize options after initialization."""
         # Validate log level
-        valid_log_levels = {"debug", "info", "warning", "error"}
-        if self.log_level not in valid_log_levels:
-            self.log_level = "info"
+        if self.log_level not in _LOG_LEVELS:
+            object.__setattr__(self, "log_level", "info")
 
         # Validate power poles
-        valid_poles = {None, "small", "medium", "big", "substation"}
-        if self.power_poles not in valid_poles:
-            self.power_poles = None
+        if self.power_poles not in _VALID_POWER_POLES:
+            object.__setattr__(self, "power_poles", None)
 
         # Sanitize blueprint name
         if self.name is not None:
-            self.name = sanitize_blueprint_name(self.name)
+            object.__setattr__(self, "name", sanitize_blueprint_name(self.name))
 
 
 def sanitize_blueprint_name(name: str | None) -> str | None:
@@ -107,7 +144,7 @@ def sanitize_blueprint_name(name: str | None) -> str | None:
         return None
 
     # Only allow alphanumeric, spaces, hyphens, underscores
-    sanitized = re.sub(r"[^a-zA-Z0-9\s\-_]", "", name)
+    sanitized = _UNSAFE_NAME_CHARS_RE.sub("", name)
 
     # Trim and limit length
     sanitized = sanitized.strip()[:100]
@@ -118,116 +155,209 @@ def sanitize_blueprint_name(name: str | None) -> str | None:
 # ==================== Compilation Queue ====================
 
 
+@dataclass
+class _Waiter:
+    """A request waiting in the compilation queue."""
+
+    event: asyncio.Event
+    position_callback: Callable[[int], None] | None = None
+
+
 class CompilationQueue:
     """
-    A queue that ensures only one compilation runs at a time.
+    A queue that limits how many compilations run at a time (one by default).
     Tracks queue position for waiting clients.
     """
 
-    def __init__(self, max_size: int = 10):
+    def __init__(self, max_size: int = 10, max_concurrent: int = 1):
         self._lock = asyncio.Lock()
-        self._queue: list[str] = []  # List of request IDs in queue
-        self._current: str | None = None  # Currently compiling request ID
-        self._events: dict[str, asyncio.Event] = {}  # Events for each waiting request
+        # Waiting requests in FIFO order; O(1) append, pop-front and removal
+        self._waiters: OrderedDict[int, _Waiter] = OrderedDict()
+        # Cached 1-based positions, refreshed whenever the waiter order changes
+        self._positions: dict[int, int] = {}
+        self._running: set[int] = set()  # Currently compiling request IDs
+        self._permits = max_concurrent
         self._max_size = max_size
 
     @property
     def queue_length(self) -> int:
         """Number of requests waiting in queue (not including current)."""
-        return len(self._queue)
+        return len(self._waiters)
 
     @property
     def is_full(self) -> bool:
         """Check if queue is at capacity."""
-        return len(self._queue) >= self._max_size
+        return len(self._waiters) >= self._max_size
+
+    @property
+    def has_free_slot(self) -> bool:
+        """Check if a new request would start compiling without waiting."""
+        return len(self._running) < self._permits and not self._waiters
 
-    def get_position(self, request_id: str) -> int:
+    def get_position(self, request_id: int) -> int:
         """Get position in queue (0 = currently compiling, 1+ = waiting)."""
-        if self._current == request_id:
+        if request_id in self._running:
             return 0
-        try:
-            return self._queue.index(request_id) + 1
-        except ValueError:
-            return -1  # Not in queue
+        return self._positions.get(request_id, -1)  # -1 = not in queue
+
+    def try_acquire(self, request_id: int) -> bool:
+        """
+        Claim a free slot without waiting. Returns False if the caller must queue.
+
+        Skips the lock and allocates nothing. This relies on asyncio running
+        one task at a time: there is no await between the check and the
+        claim, so no other task can interleave.
+        """
+        if self.has_free_slot:
+            self._running.add(request_id)
+            return True
+        return False
 
     async def acquire(
-        self, request_id: str, position_callback: Callable[[int], None] | None = None
+        self, request_id: int, position_callback: Callable[[int], None] | None = None
     ) -> tuple[bool, str | None]:
         """
         Wait for turn to compile.
         Returns (True, None) when acquired, (False, error_message) on failure.
         position_callback is called with queue position updates.
         """
+        if self.try_acquire(request_id):
+            return True, None
+
         event = asyncio.Event()
 
         async with self._lock:
-            # If nothing is compiling and queue is empty, start immediately
-            if self._current is None and len(self._queue) == 0:
-                self._current = request_id
+            # If a slot is free and queue is empty, start immediately
+            if self.has_free_slot:
+                self._running.add(request_id)
                 return True, None
 
             # Check queue capacity
-            if len(self._queue) >= self._max_size:
+            if len(self._waiters) >= self._max_size:
                 return False, "Server is busy. Please try again later."
 
             # Add to queue
-            self._queue.append(request_id)
-            self._events[request_id] = event
-            position = len(self._queue)
+            self._waiters[request_id] = _Waiter(event, position_callback)
+            position = len(self._waiters)
+            self._positions[request_id] = position
 
         # Notify initial position
         if position_callback:
             position_callback(position)
 
-        # Wait for our turn with position updates
-        while True:
-            try:
-                # Wait with timeout to periodically update position
-                await asyncio.wait_for(event.wait(), timeout=1.0)
-                break  # Event was set, we can proceed
-            except asyncio.TimeoutError:
-                # Update position
-                pos = self.get_position(request_id)
-                if pos == 0:
-                    break  # We're up!
-                if pos == -1:
-                    return False, "Removed from queue"
-                if position_callback:
-                    position_callback(pos)
+        # Position updates are pushed by release(), so just wait for our turn
+        await event.wait()
 
+        if request_id not in self._running:
+            return False, "Removed from queue"
         return True, None
 
-    async def release(self, request_id: str):
+    async def release(self, request_id: int):
         """Release the compilation slot and notify next in queue."""
         async with self._lock:
-            if self._current == request_id:
-                self._current = None
+            self._release(request_id)
+
+    def cancel(self, request_id: int):
+        """
+        Free a request's slot or queue entry without awaiting.
+
+        Used when a request gives up while waiting (timeout or disconnect)
+        and when cleanup after a compile must not be interrupted. It is safe
+        in code that may run while the task is being cancelled; like
+        try_acquire it needs no lock. If the slot was granted just as the
+        request gave up, it is passed on.
+        """
+        self._release(request_id)
+
+    def _release(self, request_id: int):
+        """Free the request's slot or queue entry and notify waiters."""
+        if request_id in self._running:
+            self._running.remove(request_id)
+
+            # Hand every free slot to the next waiter in line. Slots are
+            # claimed here, so each woken waiter is guaranteed to run.
+            while self._waiters and len(self._running) < self._permits:
+                next_id, waiter = self._waiters.popitem(last=False)
+                del self._positions[next_id]
+                self._running.add(next_id)
+                waiter.event.set()
+        elif request_id in self._waiters:
+            # Request cancelled while waiting; wake it so acquire() returns
+            del self._positions[request_id]
+            self._waiters.pop(request_id).event.set()
+        else:
+            return
 
-                # Notify next in queue
-                if self._queue:
-                    next_id = self._queue.pop(0)
-                    self._current = next_id
-                    if next_id in self._events:
-                        self._events[next_id].set()
-                        del self._events[next_id]
-            elif request_id in self._queue:
-                # Request cancelled while waiting
-                self._queue.remove(request_id)
-                if request_id in self._events:
-                    del self._events[request_id]
+        self._notify_positions()
 
+    def _notify_positions(self):
+        """Refresh cached positions and push them to every waiting request."""
+        for position, (waiting_id, waiter) in enumerate(
+            self._waiters.items(), start=1
+        ):
+            self._positions[waiting_id] = position
+            if waiter.position_callback:
+                waiter.position_callback(position)
 
-# Global compilation queue (only 1 compilation at a time)
-_compilation_queue: CompilationQueue | None = None
+
+# Process-local request IDs; they only key the queue and log lines
+_request_ids = itertools.count(1)
+
+# Global compilation queue, created at import. asyncio primitives no longer
+# bind to a loop on construction, so this is safe before the loop starts.
+_compilation_queue = CompilationQueue(
+    max_size=settings.max_queue_size,
+    max_concurrent=settings.max_concurrent_compilations,
+)
 
 
 def get_compilation_queue() -> CompilationQueue:
-    global _compilation_queue
-    if _compilation_queue is None:
-        _compilation_queue = CompilationQueue(max_size=settings.max_queue_size)
     return _compilation_queue
 
 
+# Simple check for obvious shell injection (bash-style)
+# These would never appear in Facto code which is Python-compiled
+#
+# The "$(" and "`" patterns are anchored to the line start and only look past
+# the first trigger on each line. An unanchored `\$\(.*\bsh\b` retries from
+# every "$(" and goes quadratic on sources like "$($($(...", which made the
+# sanitizer itself a ReDoS vector.
+_DANGEROUS_PATTERNS = [
+    r";\s*(rm|wget|curl)\s+-",  # Direct dangerous commands
+    r"^(?:[^$\n]|\$(?!\())*\$\(.*\bsh\b",  # $(sh ...) style
+    r"^[^`\n]*`.*\bsh\b",  # `sh ...` style
+]
+
+# Combined into a single alternation so the source is scanned only once
+_DANGEROUS_RE = re.compile(
+    "|".join(f"(?:{p})" for p in _DANGEROUS_PATTERNS), re.MULTILINE
+)
+
+
+def _has_dangerous_trigger(source: str) -> bool:
+    """Cheap substring pre-check; every dangerous pattern needs one of these."""
+    if ";" in source and ("rm" in source or "wget" in source or "curl" in source):
+        return True
+    return ("$(" in source or "`" in source) and "sh" in source
+
+
+@lru_cache(maxsize=128)
+def _source_violation(source: str) -> str | None:
+    """
+    Return why source must be rejected, or None if it passes.
+    Memoized because edit-compile loops resubmit the same source.
+    """
+    # Null bytes are never valid in text
+    if "\x00" in source:
+        return "Source code contains null bytes"
+
+    # Most sources contain none of the trigger substrings, so skip the regex
+    if _has_dangerous_trigger(source) and _DANGEROUS_RE.search(source):
+        return "Source contains potentially dangerous patterns"
+
+    return None
+
+
 def sanitize_source(source: str) -> str:
     """
     Sanitize source code to prevent injection attacks.
@@ -238,29 +368,97 @@ def sanitize_source(source: str) -> str:
     if not source or not source.strip():
         raise ValueError("Source code cannot be empty")
 
-    if len(source) > settings.max_source_length:
+    if len(source) > _MAX_SOURCE_LENGTH:
         raise ValueError(
-            f"Source code exceeds maximum length of {settings.max_source_length} characters"
+            f"Source code exceeds maximum length of {_MAX_SOURCE_LENGTH} characters"
         )
 
-    # Remove null bytes only (they're never valid in text)
-    if "\x00" in source:
-        raise ValueError("Source code contains null bytes")
+    error = _source_violation(source)
+    if error is not None:
+        raise ValueError(error)
 
-    # Simple check for obvious shell injection (bash-style)
-    # These would never appear in Facto code which is Python-compiled
-    dangerous_patterns = [
-        r";\s*(rm|wget|curl)\s+-",  # Direct dangerous commands
-        r"\$\(.*\bsh\b",  # $(sh ...) style
-        r"`.*\bsh\b",  # `sh ...` style
-    ]
+    # Lazy %-formatting: debug is off in production, so skip building the string
+    logger.debug("Source validation passed (%d chars)", len(source))
+    return source
 
-    for pattern in dangerous_patterns:
-        if re.search(pattern, source):
-            raise ValueError("Source contains potentially dangerous patterns")
 
-    logger.debug(f"Source validation passed ({len(source)} chars)")
-    return source
+class _QueueLogHandler(logging.Handler):
+    """
+    Logging handler that pushes formatted records onto an asyncio queue.
+    Records are emitted from the compiler thread, so they are handed to
+    the event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        super().__init__()
+        self._loop = loop
+        self._queue = queue
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._loop.call_soon_threadsafe(
+                self._queue.put_nowait, self.format(record)
+            )
+        except Exception:
+            self.handleError(record)
+
+
+class _ListLogHandler(logging.Handler):
+    """
+    Logging handler that collects formatted records in a list.
+    Used when logs are not streamed, so records stay in the compiler
+    thread instead of each being scheduled onto the event loop.
+    """
+
+    def __init__(self, records: list[str]):
+        super().__init__()
+        self._records = records
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._records.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _CaptureDispatcher(logging.Handler):
+    """
+    Root logging handler that routes each record to the capture handler
+    registered by the compile thread that emitted it, and drops the rest.
+
+    Concurrent compiles share the root logger, so this keeps each user's
+    stream to their own compile. It stays attached for the life of the
+    process, so a compile that outlives its request never finds the root
+    without handlers and makes logging.info() call basicConfig().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._handlers: dict[int, logging.Handler] = {}
+
+    def register(self, handler: logging.Handler):
+        """Capture the calling thread's records with handler."""
+        self._handlers[threading.get_ident()] = handler
+
+    def unregister(self, handler: logging.Handler):
+        """Stop capturing records with handler, from whichever thread."""
+        for ident, registered in list(self._handlers.items()):
+            if registered is handler:
+                self._handlers.pop(ident, None)
+
+    def emit(self, record: logging.LogRecord):
+        handler = self._handlers.get(record.thread)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+
+_capture_dispatcher = _CaptureDispatcher()
+logging.getLogger().addHandler(_capture_dispatcher)
+
+# The compiler logs at INFO and above through the root logger, so the root
+# must pass INFO; the requested level is applied by each capture handler
+if logging.getLogger().level > logging.INFO:
+    logging.getLogger().setLevel(logging.INFO)
 
 
 async def compile_facto_direct(
@@ -270,96 +468,78 @@ async def compile_facto_direct(
     Compile Facto source code directly using the in-process compiler.
     Yields tuples of (output_type, content) for streaming to frontend.
 
-    Captures logging output in real-time and streams it to the client.
+    Captures logging output in real-time and streams it to the client, or
+    yields it all after compiling when options.stream_logs is False.
+    Expects source that has already passed sanitize_source.
     """
-    import io
-    import logging as py_logging
-    from logging import StreamHandler
-
     try:
         logger.info(
             f"Starting compilation with options: optimize={not options.no_optimize}, power_poles={options.power_poles}"
         )
 
-        # Sanitize input first
-        try:
-            source = sanitize_source(source)
-        except ValueError as e:
-            logger.warning(f"Source validation failed: {e}")
-            yield (OutputType.ERROR, str(e))
-            return
-
         yield (OutputType.STATUS, "Compiling...")
 
-        # Create a string buffer to capture log output
-        log_stream = io.StringIO()
-        log_handler = StreamHandler(log_stream)
-        log_handler.setLevel(getattr(py_logging, options.log_level.upper()))
-        log_handler.setFormatter(py_logging.Formatter("%(levelname)s: %(message)s"))
-
-        # Get the dsl_compiler logger and add our handler
-        dsl_logger = py_logging.getLogger("dsl_compiler")
-        root_logger = py_logging.getLogger()
-
-        # Store original level and add handler
-        original_dsl_level = dsl_logger.level
-        original_root_level = root_logger.level
-
-        dsl_logger.addHandler(log_handler)
-        root_logger.addHandler(log_handler)
-        dsl_logger.setLevel(getattr(py_logging, options.log_level.upper()))
-        root_logger.setLevel(getattr(py_logging, options.log_level.upper()))
-
-        # Run compilation in executor to not block event loop
-        # and allow us to capture logs progressively
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
+        log_level = _LOG_LEVELS[options.log_level]
+        if options.stream_logs:
+            # Forward log records to the generator as they are emitted
+            log_lines: asyncio.Queue[str | None] = asyncio.Queue()
+            log_handler = _QueueLogHandler(loop, log_lines)
+        else:
+            collected_logs: list[str] = []
+            log_handler = _ListLogHandler(collected_logs)
+        log_handler.setLevel(log_level)
+        log_handler.setFormatter(_CAPTURE_FORMATTER)
 
         def run_compile():
-            # Always compile with JSON output to get the data structure
-            return compile_dsl_source(
-                source_code=source,
-                source_name="<web>",
-                program_name=options.name,
-                optimize=not options.no_optimize,
-                log_level=options.log_level,
-                power_pole_type=options.power_poles,
-                use_json=True,  # Always get JSON
-            )
-
-        # Run compilation in thread pool
-        compile_task = loop.run_in_executor(None, run_compile)
-
-        # Poll for log output while compilation runs
-        last_pos = 0
-        while not compile_task.done():
-            await asyncio.sleep(0.1)  # Check every 100ms
+            # Capture only this thread's records, and stop before the thread
+            # returns to the pool where another compile may pick it up
+            _capture_dispatcher.register(log_handler)
+            try:
+                # Always compile with JSON output to get the data structure
+                return compile_dsl_source(
+                    source_code=source,
+                    source_name="<web>",
+                    program_name=options.name,
+                    optimize=not options.no_optimize,
+                    log_level=options.log_level,
+                    power_pole_type=options.power_poles,
+                    use_json=True,  # Always get JSON
+                )
+            finally:
+                _capture_dispatcher.unregister(log_handler)
 
-            # Get new log content
-            current_content = log_stream.getvalue()
-            if len(current_content) > last_pos:
-                new_logs = current_content[last_pos:]
-                for line in new_logs.splitlines():
+        try:
+            # Run compilation in the dedicated compiler thread pool so the
+            # event loop stays free to stream logs
+            compile_task = loop.run_in_executor(_compile_executor, run_compile)
+
+            if options.stream_logs:
+                # Records emitted before the compiler returned are already
+                # queued ahead of this sentinel, since both go through the loop
+                compile_task.add_done_callback(lambda _: log_lines.put_nowait(None))
+
+                while True:
+                    text = await log_lines.get()
+                    if text is None:
+                        break
+                    for line in text.splitlines():
+                        if line.strip():
+                            yield (OutputType.LOG, line)
+
+            # Get final result
+            success, result, diagnostics = await compile_task
+        finally:
+            # Clean up logging handler; a compile abandoned by its client
+            # keeps running, but its records are dropped from here on
+            _capture_dispatcher.unregister(log_handler)
+            log_handler.close()
+
+        if not options.stream_logs:
+            for text in collected_logs:
+                for line in text.splitlines():
                     if line.strip():
                         yield (OutputType.LOG, line)
-                last_pos = len(current_content)
-
-        # Get final result
-        success, result, diagnostics = await compile_task
-
-        # Flush any remaining logs
-        current_content = log_stream.getvalue()
-        if len(current_content) > last_pos:
-            new_logs = current_content[last_pos:]
-            for line in new_logs.splitlines():
-                if line.strip():
-                    yield (OutputType.LOG, line)
-
-        # Clean up logging handler
-        dsl_logger.removeHandler(log_handler)
-        root_logger.removeHandler(log_handler)
-        dsl_logger.setLevel(original_dsl_level)
-        root_logger.setLevel(original_root_level)
-        log_handler.close()
 
         # Stream diagnostic messages as logs
         if diagnostics:
@@ -371,9 +551,13 @@ async def compile_facto_direct(
             logger.info("Compilation successful")
             yield (OutputType.STATUS, "Compilation successful!")
             
+            # Serializing and compressing large blueprints is CPU-bound, so it
+            # runs off the event loop. It uses the default executor rather than
+            # the compile pool, whose threads may all be busy compiling
+
             # result is now JSON - ensure it's a string for SSE transmission
             if isinstance(result, dict):
-                json_str = json.dumps(result)
+                json_str = await asyncio.to_thread(json.dumps, result)
             else:
                 json_str = result
             
@@ -382,11 +566,7 @@ async def compile_facto_direct(
             
             # Convert to blueprint and yield
             try:
-                if isinstance(result, dict):
-                    json_data = result
-                else:
-                    json_data = json.loads(result)
-                blueprint = json_to_blueprint(json_data)
+                blueprint = await asyncio.to_thread(_result_to_blueprint, result)
                 yield (OutputType.BLUEPRINT, blueprint)
             except Exception as e:
                 logger.error(f"Failed to convert JSON to blueprint: {e}")
@@ -412,89 +592,105 @@ async def compile_facto(
     Handles queuing and resource management.
     """
     queue = get_compilation_queue()
-    request_id = str(uuid.uuid4())
+    request_id = next(_request_ids)
 
     logger.info(f"New compilation request {request_id}")
 
-    # Track queue position updates to yield
-    position_updates: list[int] = []
+    # Sanitize input before queueing, so invalid sources never hold a slot
+    try:
+        source = sanitize_source(source)
+    except ValueError as e:
+        logger.warning(f"Request {request_id} source validation failed: {e}")
+        yield (OutputType.ERROR, str(e))
+        return
 
-    def on_position_update(pos: int):
-        position_updates.append(pos)
+    start_wait = time.perf_counter()
 
-    # Check initial queue length
-    initial_queue_length = queue.queue_length
-    if initial_queue_length > 0 or queue._current is not None:
-        logger.info(
-            f"Request {request_id} queued at position {initial_queue_length + 1}"
-        )
-        yield (OutputType.QUEUE, str(initial_queue_length + 1))
-        yield (
-            OutputType.STATUS,
-            f"Waiting in queue (position {initial_queue_length + 1})...",
-        )
+    # Fast path: a slot is free, so skip the waiting machinery entirely
+    if not queue.try_acquire(request_id):
+        # The queue pushes our position here whenever the line moves. Only the
+        # latest position matters, so a newer one replaces any unread one.
+        position_updates: asyncio.Queue[int] = asyncio.Queue(maxsize=1)
 
-    # Try to acquire slot with timeout
-    try:
+        def on_position_update(pos: int):
+            if position_updates.full():
+                position_updates.get_nowait()
+            position_updates.put_nowait(pos)
+
+        logger.info(f"Request {request_id} waiting for a compilation slot")
         acquire_task = asyncio.create_task(
             queue.acquire(request_id, on_position_update)
         )
+        update_task: asyncio.Future | None = None
+        acquired = False
+        timed_out = False
 
-        # Wait for slot with periodic position updates and overall timeout
-        start_wait = time.perf_counter()
-        while not acquire_task.done():
-            try:
-                await asyncio.wait_for(asyncio.shield(acquire_task), timeout=1.0)
-            except asyncio.TimeoutError:
-                # Check overall queue timeout
-                if time.perf_counter() - start_wait > settings.queue_timeout:
-                    logger.warning(f"Request {request_id} timed out in queue")
-                    await queue.release(request_id)
-                    yield (
-                        OutputType.ERROR,
-                        "Queue timeout. Server is very busy. Please try again later.",
+        try:
+            # Sleep until the slot is granted, our position changes or the
+            # queue timeout expires; nothing wakes up periodically. The timeout
+            # only wraps the wait so it never spans a yield to the client.
+            deadline = asyncio.get_running_loop().time() + _QUEUE_TIMEOUT
+            while not acquire_task.done():
+                update_task = asyncio.ensure_future(position_updates.get())
+                async with asyncio.timeout_at(deadline):
+                    done, _ = await asyncio.wait(
+                        {acquire_task, update_task},
+                        return_when=asyncio.FIRST_COMPLETED,
                     )
-                    return
-                # Yield any position updates
-                while position_updates:
-                    pos = position_updates.pop(0)
+
+                if update_task in done:
+                    pos = update_task.result()
                     yield (OutputType.QUEUE, str(pos))
                     yield (OutputType.STATUS, f"Waiting in queue (position {pos})...")
 
-        success, error_msg = acquire_task.result()
-        if not success:
-            logger.warning(f"Request {request_id} failed to acquire slot: {error_msg}")
-            yield (OutputType.ERROR, error_msg or "Failed to acquire compilation slot")
+            success, error_msg = acquire_task.result()
+            if not success:
+                logger.warning(
+                    f"Request {request_id} failed to acquire slot: {error_msg}"
+                )
+                yield (
+                    OutputType.ERROR,
+                    error_msg or "Failed to acquire compilation slot",
+                )
+                return
+            acquired = True
+
+        except asyncio.TimeoutError:
+            timed_out = True
+
+        finally:
+            if update_task is not None:
+                update_task.cancel()
+            if not acquired:
+                # Timed out or the client went away: leave the queue before
+                # anything else can suspend us
+                acquire_task.cancel()
+                queue.cancel(request_id)
+
+        if timed_out:
+            logger.warning(f"Request {request_id} timed out in queue")
+            yield (
+                OutputType.ERROR,
+                "Queue timeout. Server is very busy. Please try again later.",
+            )
             return
 
-    except asyncio.TimeoutError:
-        logger.warning(f"Request {request_id} timed out acquiring slot")
-        yield (
-            OutputType.ERROR,
-            "Queue timeout. Server is very busy. Please try again later.",
-        )
-        await queue.release(request_id)
-        return
-
-    # Now we have the slot, yield position 0
     logger.info(f"Request {request_id} acquired compilation slot")
-    yield (OutputType.QUEUE, "0")
-    
-    # Record queue wait time
     queue_wait_time = time.perf_counter() - start_wait
-    
-    # Record compilation start
     stats = get_stats()
-    await stats.record_compilation_start()
-    await stats.record_queue_wait(queue_wait_time)
-    
-    # Update current queue length
-    await stats.update_queue_length(queue.queue_length)
-    
     compilation_success = False
     compilation_start = time.perf_counter()
 
+    # Everything from here on holds the slot, so it all sits inside the
+    # try whose finally releases it, even if the client disconnects early
     try:
+        # Now we have the slot, yield position 0
+        yield (OutputType.QUEUE, "0")
+
+        # Record queue wait time and current queue length
+        await stats.record_queue_wait(queue_wait_time)
+        await stats.update_queue_length(queue.queue_length)
+
         # Compile directly in-process
         async for output_type, content in compile_facto_direct(source, options):
             yield (output_type, content)
@@ -506,6 +702,10 @@ async def compile_facto(
         yield (OutputType.ERROR, f"Compilation error: {str(e)}")
 
     finally:
+        # Free the slot before anything that can suspend: on a disconnect
+        # every await below may be cancelled again, which would leak it
+        queue.cancel(request_id)
+
         # Record compilation result with timing
         compilation_duration = time.perf_counter() - compilation_start
         total_duration = time.perf_counter() - start_wait
@@ -513,11 +713,6 @@ async def compile_facto(
             f"Request {request_id} completed in {compilation_duration:.2f}s (total: {total_duration:.2f}s), success={compilation_success}"
         )
 
-        if compilation_success:
-            await stats.record_compilation_success(compilation_duration)
-        else:
-            await stats.record_compilation_failure(compilation_duration)
-        
+        await stats.record_compilation(compilation_success, compilation_duration)
         await stats.record_total_request_time(total_duration)
         await stats.update_queue_length(queue.queue_length)
-        await queue.release(request_id)
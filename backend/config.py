@@ -27,12 +27,15 @@ class Settings(BaseSettings):
     # Compilation limits
     max_source_length: int = 50000  # 50KB max source code
     compilation_timeout: int = 30  # seconds
-    max_concurrent_compilations: int = 1  # Queue ensures single compilation
+    max_concurrent_compilations: int = 1  # Compilations the queue runs at once
 
     # Queue settings
     max_queue_size: int = 100  # Maximum pending compilations
     queue_timeout: int = 500  # Max time to wait in queue (seconds)
 
+    # Statistics
+    stats_flush_interval: float = 5.0  # Seconds between stats file writes
+
     # Facto compiler path (adjust to your installation)
     facto_compiler_path: str = "factompile"
 
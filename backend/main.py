@@ -10,7 +10,7 @@ from slowapi.errors import RateLimitExceeded
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from config import get_settings
-from rate_limiter import limiter, rate_limit_exceeded_handler
+from rate_limiter import RATE_LIMIT, limiter, rate_limit_exceeded_handler
 from compiler_service import (
     compile_facto,
     CompilerOptions,
@@ -85,6 +85,12 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def flush_stats():
+    """Write any pending statistics before the server exits."""
+    await get_stats().aclose()
+
+
 # ==================== Request Models ====================
 
 
@@ -120,7 +126,7 @@ async def connect():
 
 
 @app.post("/compile")
-@limiter.limit(f"{settings.rate_limit_requests}/{settings.rate_limit_window}seconds")
+@limiter.limit(RATE_LIMIT)
 async def compile_code(request: Request, body: CompileRequest):
     """
     Compile Facto code and stream the output.
@@ -167,7 +173,7 @@ async def compile_code(request: Request, body: CompileRequest):
 
 
 @app.post("/compile/sync")
-@limiter.limit(f"{settings.rate_limit_requests}/{settings.rate_limit_window}seconds")
+@limiter.limit(RATE_LIMIT)
 async def compile_code_sync(request: Request, body: CompileRequest):
     """
     Compile Facto code and return all results at once.
@@ -183,6 +189,7 @@ async def compile_code_sync(request: Request, body: CompileRequest):
         no_optimize=body.no_optimize,
         json_output=body.json_output,
         log_level=body.log_level,
+        stream_logs=False,  # Logs are returned in one batch anyway
     )
 
     logs = []
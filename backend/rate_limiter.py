@@ -10,6 +10,9 @@ from config import get_settings
 
 settings = get_settings()
 
+# Shared by the limiter defaults and the per-route decorators in main.py
+RATE_LIMIT = f"{settings.rate_limit_requests}/{settings.rate_limit_window}seconds"
+
 
 def get_real_client_ip(request: Request) -> str:
     """
@@ -26,7 +29,7 @@ def get_real_client_ip(request: Request) -> str:
     # Take the first (leftmost) IP which is the original client
     forwarded_for = request.headers.get("X-Forwarded-For")
     if forwarded_for:
-        return forwarded_for.split(",")[0].strip()
+        return forwarded_for.partition(",")[0].strip()
 
     # X-Real-IP header (commonly set by nginx)
     real_ip = request.headers.get("X-Real-IP")
@@ -40,9 +43,7 @@ def get_real_client_ip(request: Request) -> str:
 # Create limiter instance using proxy-aware IP detection
 limiter = Limiter(
     key_func=get_real_client_ip,
-    default_limits=[
-        f"{settings.rate_limit_requests}/{settings.rate_limit_window}seconds"
-    ],
+    default_limits=[RATE_LIMIT],
 )
 
 
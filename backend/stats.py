@@ -1,11 +1,17 @@
 """Simple statistics collection for Facto web compiler."""
 
 import asyncio
-from datetime import datetime
+import json
+import os
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
-import yaml
+from config import get_settings
 
 
 # How many recent compilation times to keep for statistics
@@ -13,16 +19,77 @@ MAX_RECENT_TIMES = 100
 
 # Default stats file location (in data/ subdirectory)
 DEFAULT_STATS_DIR = Path(__file__).parent / "data"
-DEFAULT_STATS_FILE = DEFAULT_STATS_DIR / "stats.yaml"
+DEFAULT_STATS_FILE = DEFAULT_STATS_DIR / "stats.json"
+
+# Recent time series persisted with the stats, mapped to their summary prefix
+TIME_SERIES = {
+    "compilation_times": "compilation_time",
+    "queue_wait_times": "queue_wait",
+    "total_request_times": "total_request",
+}
+
+
+@lru_cache(maxsize=1)
+def _iso_for_second(second: int) -> str:
+    """Format a Unix second as an ISO 8601 UTC timestamp."""
+    return datetime.fromtimestamp(second, timezone.utc).isoformat()
+
+
+def _utc_now_iso() -> str:
+    """Current UTC time as ISO 8601, reformatted at most once per second."""
+    return _iso_for_second(int(time.time()))
+
+
+class _RecentTimes:
+    """Sliding window of recent times with incrementally maintained summary."""
+
+    def __init__(self, values: list[float], maxlen: int = MAX_RECENT_TIMES):
+        self._times: deque[float] = deque(maxlen=maxlen)
+        self._sorted: list[float] = []
+        self._sum = 0.0
+        for value in values[-maxlen:]:
+            self.add(value)
+
+    def add(self, value: float):
+        """Add a time, evicting the oldest one when the window is full."""
+        if len(self._times) == self._times.maxlen:
+            oldest = self._times[0]
+            self._sum -= oldest
+            del self._sorted[bisect_left(self._sorted, oldest)]
+        self._times.append(value)
+        insort(self._sorted, value)
+        self._sum += value
+
+    def summary(self) -> dict[str, float]:
+        """Return avg, median, min and max of the window."""
+        n = len(self._sorted)
+        if n % 2 == 0:
+            median = (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2
+        else:
+            median = self._sorted[n // 2]
+        return {
+            "avg": self._sum / n,
+            "median": median,
+            "min": self._sorted[0],
+            "max": self._sorted[-1],
+        }
+
+    def to_list(self) -> list[float]:
+        return list(self._times)
 
 
 class Stats:
     """
-    Simple statistics tracker that persists to a YAML file.
+    Simple statistics tracker that persists to a JSON file.
     Thread-safe for async operations.
+
+    Changes are written by a background task at most once per flush_interval
+    seconds rather than on every update.
     """
 
-    def __init__(self, stats_file: Path | str | None = None):
+    def __init__(
+        self, stats_file: Path | str | None = None, flush_interval: float = 5.0
+    ):
         if stats_file is None:
             stats_file = DEFAULT_STATS_FILE
 
@@ -32,15 +99,37 @@ class Stats:
         self._file_path.parent.mkdir(parents=True, exist_ok=True)
 
         self._lock = asyncio.Lock()
+        # Serializes file writes, which happen outside self._lock
+        self._write_lock = asyncio.Lock()
         self._data: dict[str, Any] = self._load_or_init()
+        # Raw time lists live here and are only merged back in when saving
+        self._recent = {
+            key: _RecentTimes(self._data.pop(key) or []) for key in TIME_SERIES
+        }
+
+        self._flush_interval = flush_interval
+        self._dirty = False  # Unsaved changes pending
+        self._flush_task: asyncio.Task | None = None
 
     def _load_or_init(self) -> dict[str, Any]:
         """Load existing stats or initialize new ones."""
         if self._file_path.exists():
             try:
-                with open(self._file_path, "r") as f:
+                data = json.loads(self._file_path.read_text()) or {}
+                # Ensure all required fields exist
+                self._ensure_fields(data)
+                return data
+            except Exception:
+                pass
+
+        # Older versions stored stats as YAML next to the JSON file
+        legacy_path = self._file_path.with_suffix(".yaml")
+        if legacy_path.exists():
+            try:
+                import yaml
+
+                with open(legacy_path, "r") as f:
                     data = yaml.safe_load(f) or {}
-                    # Ensure all required fields exist
                     self._ensure_fields(data)
                     return data
             except Exception:
@@ -51,8 +140,8 @@ class Stats:
     def _create_initial_data(self) -> dict[str, Any]:
         """Create initial stats structure."""
         return {
-            "created_at": datetime.utcnow().isoformat(),
-            "last_updated": datetime.utcnow().isoformat(),
+            "created_at": _utc_now_iso(),
+            "last_updated": _utc_now_iso(),
             "unique_sessions": 0,
             "total_compilations": 0,
             "successful_compilations": 0,
@@ -86,20 +175,77 @@ class Stats:
             if key not in data:
                 data[key] = value
 
-    async def _save(self):
-        """Save stats to YAML file."""
-        self._data["last_updated"] = datetime.utcnow().isoformat()
+    def _snapshot(self) -> dict[str, Any]:
+        """Copy the stats as saved, including the raw times lists."""
+        self._data["last_updated"] = _utc_now_iso()
+        data = dict(self._data)
+        for key, recent in self._recent.items():
+            data[key] = recent.to_list()
+        return data
+
+    def _write(self, data: dict[str, Any]):
+        """Atomically write a stats snapshot to the JSON file (blocking)."""
+        tmp_path = self._file_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, separators=(",", ":")))
+        os.replace(tmp_path, self._file_path)
+
+    async def _save(self, data: dict[str, Any]) -> bool:
+        """
+        Save a snapshot to the JSON file without blocking the event loop.
+        Returns whether the write succeeded.
+        """
         try:
-            with open(self._file_path, "w") as f:
-                yaml.dump(self._data, f, default_flow_style=False, sort_keys=False)
+            await asyncio.to_thread(self._write, data)
+            return True
         except Exception as e:
             print(f"Warning: Could not save stats: {e}")
+            return False
+
+    def _mark_dirty(self):
+        """Flag unsaved changes and start the background flusher if needed."""
+        self._dirty = True
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flusher())
+
+    async def _flusher(self):
+        """Periodically write pending changes to disk."""
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            # Shielded so cancelling the flusher never interrupts a write
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        """Write pending changes to disk now."""
+        # Snapshots are taken and written in turn, so an older one never
+        # lands after a newer one
+        async with self._write_lock:
+            # Only the snapshot is taken under self._lock; recording never
+            # waits for the disk
+            async with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                data = self._snapshot()
+            if not await self._save(data):
+                # Keep the changes pending so the next flush retries them
+                self._dirty = True
+
+    async def aclose(self):
+        """Stop the background flusher and write any pending changes."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
 
     async def record_session(self):
         """Record a new session (frontend connect)."""
         async with self._lock:
             self._data["unique_sessions"] = self._data.get("unique_sessions", 0) + 1
-            await self._save()
+            self._mark_dirty()
 
     async def record_compilation_start(self):
         """Record start of a compilation."""
@@ -107,72 +253,43 @@ class Stats:
             self._data["total_compilations"] = (
                 self._data.get("total_compilations", 0) + 1
             )
-            await self._save()
+            self._mark_dirty()
+
+    async def record_compilation(self, success: bool, duration_seconds: float):
+        """Record a finished compilation (count, result and timing) at once."""
+        async with self._lock:
+            self._data["total_compilations"] = (
+                self._data.get("total_compilations", 0) + 1
+            )
+            self._record_result(success, duration_seconds)
+            self._mark_dirty()
 
     async def record_compilation_success(self, duration_seconds: float):
         """Record successful compilation with timing."""
         async with self._lock:
-            self._data["successful_compilations"] = (
-                self._data.get("successful_compilations", 0) + 1
-            )
-            self._record_compilation_time(duration_seconds)
-            await self._save()
+            self._record_result(True, duration_seconds)
+            self._mark_dirty()
 
     async def record_compilation_failure(self, duration_seconds: float):
         """Record failed compilation with timing."""
         async with self._lock:
-            self._data["failed_compilations"] = (
-                self._data.get("failed_compilations", 0) + 1
-            )
-            self._record_compilation_time(duration_seconds)
-            await self._save()
+            self._record_result(False, duration_seconds)
+            self._mark_dirty()
 
-    def _record_compilation_time(self, duration: float):
-        """Record a compilation time and update statistics."""
-        times = self._data.get("compilation_times", [])
-        times.append(round(duration, 3))
+    def _record_result(self, success: bool, duration: float):
+        """Count a compilation result and record its time."""
+        key = "successful_compilations" if success else "failed_compilations"
+        self._data[key] = self._data.get(key, 0) + 1
+        self._record_time("compilation_times", duration)
 
-        # Keep only recent times
-        if len(times) > MAX_RECENT_TIMES:
-            times = times[-MAX_RECENT_TIMES:]
+    def _record_time(self, key: str, duration: float):
+        """Record a time in one of the recent series and update its statistics."""
+        recent = self._recent[key]
+        recent.add(round(duration, 3))
 
-        self._data["compilation_times"] = times
-
-        # Update time statistics
-        if times:
-            sorted_times = sorted(times)
-            self._data["avg_compilation_time_seconds"] = round(
-                sum(times) / len(times), 3
-            )
-            self._data["min_compilation_time_seconds"] = sorted_times[0]
-            self._data["max_compilation_time_seconds"] = sorted_times[-1]
-
-            # Median
-            n = len(sorted_times)
-            if n % 2 == 0:
-                median = (sorted_times[n // 2 - 1] + sorted_times[n // 2]) / 2
-            else:
-                median = sorted_times[n // 2]
-            self._data["median_compilation_time_seconds"] = round(median, 3)
-
-    def _compute_time_stats(self, times_list: list[float], prefix: str):
-        """Compute and update statistics for a time series."""
-        if not times_list:
-            return
-        
-        sorted_times = sorted(times_list)
-        n = len(sorted_times)
-        
-        self._data[f"avg_{prefix}_seconds"] = round(sum(sorted_times) / n, 3)
-        self._data[f"min_{prefix}_seconds"] = round(sorted_times[0], 3)
-        self._data[f"max_{prefix}_seconds"] = round(sorted_times[-1], 3)
-        
-        # Median
-        if n % 2 == 0:
-            median = (sorted_times[n // 2 - 1] + sorted_times[n // 2]) / 2
-        else:
-            median = sorted_times[n // 2]
-        self._data[f"median_{prefix}_seconds"] = round(median, 3)
+        prefix = TIME_SERIES[key]
+        for stat, value in recent.summary().items():
+            self._data[f"{stat}_{prefix}_seconds"] = round(value, 3)
 
     async def record_queue_wait(self, wait_time: float):
         """Record time spent waiting in queue."""
@@ -180,29 +297,14 @@ class Stats:
             self._data["total_queued_requests"] = (
                 self._data.get("total_queued_requests", 0) + 1
             )
-            
-            wait_times = self._data.get("queue_wait_times", [])
-            wait_times.append(round(wait_time, 3))
-            
-            if len(wait_times) > MAX_RECENT_TIMES:
-                wait_times = wait_times[-MAX_RECENT_TIMES:]
-            
-            self._data["queue_wait_times"] = wait_times
-            self._compute_time_stats(wait_times, "queue_wait")
-            await self._save()
+            self._record_time("queue_wait_times", wait_time)
+            self._mark_dirty()
 
     async def record_total_request_time(self, total_time: float):
         """Record total request time (queue wait + compilation)."""
         async with self._lock:
-            total_times = self._data.get("total_request_times", [])
-            total_times.append(round(total_time, 3))
-            
-            if len(total_times) > MAX_RECENT_TIMES:
-                total_times = total_times[-MAX_RECENT_TIMES:]
-            
-            self._data["total_request_times"] = total_times
-            self._compute_time_stats(total_times, "total_request")
-            await self._save()
+            self._record_time("total_request_times", total_time)
+            self._mark_dirty()
 
     async def update_queue_length(self, queue_length: int):
         """Update current queue length."""
@@ -214,16 +316,12 @@ class Stats:
             if queue_length > max_seen:
                 self._data["max_queue_length_seen"] = queue_length
             
-            await self._save()
+            self._mark_dirty()
 
     def get_stats(self) -> dict[str, Any]:
         """Get current statistics (excluding raw times lists)."""
-        result = dict(self._data)
-        # Don't expose the raw times lists
-        result.pop("compilation_times", None)
-        result.pop("queue_wait_times", None)
-        result.pop("total_request_times", None)
-        return result
+        # Raw times lists are held in self._recent, not self._data
+        return dict(self._data)
 
 
 # Global stats instance
@@ -234,5 +332,5 @@ def get_stats() -> Stats:
     """Get the global stats instance."""
     global _stats
     if _stats is None:
-        _stats = Stats()
+        _stats = Stats(flush_interval=get_settings().stats_flush_interval)
     return _stats
@@ -5,17 +5,33 @@ Stress test script for Facto web compiler.
 Sends a large volume of compile requests to test system behavior under load.
 
 Usage:
-    python3 stress_test.py [--url URL] [--requests N] [--concurrent N] [--duration SECONDS]
+    python3 stress_test.py [--url URL] [--requests N] [--concurrent N] [--duration SECONDS] [--workers N] [--quiet]
+
+While a test runs, send SIGUSR1 to double or SIGUSR2 to halve the concurrency
+(with --workers, signal the worker processes).
 """
 
 import argparse
 import asyncio
+import itertools
 import json
+import math
+import multiprocessing
+import signal
+import sys
 import time
+from array import array
+from collections import deque
 from datetime import datetime
-from typing import List, Dict, Any
+from enum import IntEnum
+from typing import List, Dict, Any, Tuple
 import aiohttp
 
+try:
+    import uvloop
+except ImportError:  # uvloop is optional; the default asyncio loop is used
+    uvloop = None
+
 
 # Sample Facto code for testing
 SAMPLE_FACTO_CODE = """
@@ -60,38 +76,168 @@ for y in 0..3 {
 }
 """
 
+# Requests send a pre-serialized body, so the content type is set explicitly
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Headers aiohttp would add to every request that the backend ignores
+SKIP_AUTO_HEADERS = ("User-Agent", "Accept-Encoding")
+
+
+class LatencyHistogram:
+    """
+    Log-scale histogram of response times that uses constant memory.
+
+    4096 buckets span 0.1 ms to 600 s, so each bucket is about 0.4% wide and
+    percentiles read from it are within that relative error. Count, sum,
+    min and max are tracked exactly.
+    """
+
+    BUCKETS = 4096
+    MIN_SECONDS = 1e-4
+    MAX_SECONDS = 600.0
+    _SCALE = (BUCKETS - 1) / math.log(MAX_SECONDS / MIN_SECONDS)
+    _LOG_MIN = math.log(MIN_SECONDS)
+
+    def __init__(self):
+        self.counts = array("I", [0]) * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, seconds: float, _log=math.log):
+        """Record one response time."""
+        # Plain comparisons instead of min()/max() calls: this runs per request
+        if seconds > self.MIN_SECONDS:
+            index = int((_log(seconds) - self._LOG_MIN) * self._SCALE)
+            if index >= self.BUCKETS:
+                index = self.BUCKETS - 1
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentiles(self, percents: List[int]) -> List[float]:
+        """
+        Nearest-rank percentiles for ascending integer percents: the value at
+        1-based rank ceil(p/100 * n), computed in integers to avoid rounding.
+        """
+        return self.values_at_ranks(
+            [-(-p * self.count // 100) - 1 for p in percents]
+        )
+
+    def merge(self, other: "LatencyHistogram"):
+        """Add another histogram's samples to this one."""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def values_at_ranks(self, ranks: List[int]) -> List[float]:
+        """
+        Approximate the values at the given ascending 0-based ranks of the
+        sorted samples, in one walk over the cumulative bucket counts.
+        """
+        values = []
+        pending = iter(ranks)
+        rank = next(pending, None)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while rank is not None and rank < seen:
+                values.append(self._bucket_value(index))
+                rank = next(pending, None)
+            if rank is None:
+                break
+        return values
+
+    def _bucket_value(self, index: int) -> float:
+        """Geometric midpoint of a bucket, clamped to the observed range."""
+        value = self.MIN_SECONDS * math.exp((index + 0.5) / self._SCALE)
+        return min(max(value, self.min), self.max)
+
+
+class Outcome(IntEnum):
+    """Result of a single request; values index StressTestStats.outcome_counts."""
+
+    SUCCESS = 0
+    TIMEOUT = 1
+    CONNECTION = 2
+    RATE_LIMIT = 3
+    UNKNOWN = 4
+
 
 class StressTestStats:
     """Track stress test statistics."""
 
     def __init__(self):
         self.total_requests = 0
-        self.successful_requests = 0
-        self.failed_requests = 0
-        self.timeouts = 0
-        self.connection_errors = 0
-        self.rate_limit_errors = 0
-        self.response_times: List[float] = []
+        # Requests per Outcome, indexed by the outcome's value
+        self.outcome_counts = [0] * len(Outcome)
+        # Constant memory however long the test runs
+        self.response_times = LatencyHistogram()
         self.start_time = None
         self.end_time = None
+        # (total_requests, end_time, summary) from the last get_summary call
+        self._cached_summary = None
+
+    @property
+    def successful_requests(self) -> int:
+        return self.outcome_counts[Outcome.SUCCESS]
+
+    @property
+    def failed_requests(self) -> int:
+        return self.total_requests - self.successful_requests
+
+    def record(self, outcome: Outcome, duration: float):
+        """Record a finished request as returned by send_compile_request."""
+        self.total_requests += 1
+        self.outcome_counts[outcome] += 1
+        if outcome is Outcome.SUCCESS:
+            self.response_times.add(duration)
+
+    def merge(self, other: "StressTestStats"):
+        """Fold in the results of another worker's run."""
+        self.total_requests += other.total_requests
+        for outcome in Outcome:
+            self.outcome_counts[outcome] += other.outcome_counts[outcome]
+        self.response_times.merge(other.response_times)
+        # time.monotonic() is system-wide, so times compare across processes
+        if self.start_time is None or other.start_time < self.start_time:
+            self.start_time = other.start_time
+        if self.end_time is None or other.end_time > self.end_time:
+            self.end_time = other.end_time
+        self._cached_summary = None
+
+    def get_summary(self, max_stale: int = 0) -> Dict[str, Any]:
+        """
+        Get summary statistics.
+
+        The last summary is reused while at most max_stale requests have
+        finished since it was computed, so a live display can poll this
+        cheaply. The default only reuses an exactly current summary.
+        """
+        cached = self._cached_summary
+        if (
+            cached is not None
+            and cached[1] == self.end_time
+            and self.total_requests - cached[0] <= max_stale
+        ):
+            return dict(cached[2])
 
-    def record_success(self, duration: float):
-        """Record a successful request."""
-        self.successful_requests += 1
-        self.response_times.append(duration)
-
-    def record_failure(self, error_type: str = "unknown"):
-        """Record a failed request."""
-        self.failed_requests += 1
-        if error_type == "timeout":
-            self.timeouts += 1
-        elif error_type == "connection":
-            self.connection_errors += 1
-        elif error_type == "rate_limit":
-            self.rate_limit_errors += 1
-
-    def get_summary(self) -> Dict[str, Any]:
-        """Get summary statistics."""
         total_time = (
             (self.end_time - self.start_time)
             if self.start_time and self.end_time
@@ -102,9 +248,9 @@ class StressTestStats:
             "total_requests": self.total_requests,
             "successful_requests": self.successful_requests,
             "failed_requests": self.failed_requests,
-            "timeouts": self.timeouts,
-            "connection_errors": self.connection_errors,
-            "rate_limit_errors": self.rate_limit_errors,
+            "timeouts": self.outcome_counts[Outcome.TIMEOUT],
+            "connection_errors": self.outcome_counts[Outcome.CONNECTION],
+            "rate_limit_errors": self.outcome_counts[Outcome.RATE_LIMIT],
             "success_rate": round(
                 self.successful_requests / self.total_requests * 100, 2
             )
@@ -113,26 +259,19 @@ class StressTestStats:
             "total_duration_seconds": round(total_time, 2),
         }
 
-        if self.response_times:
-            sorted_times = sorted(self.response_times)
-            n = len(sorted_times)
+        times = self.response_times
+        if times:
+            n = len(times)
 
-            summary["avg_response_time_seconds"] = round(sum(sorted_times) / n, 3)
-            summary["min_response_time_seconds"] = round(sorted_times[0], 3)
-            summary["max_response_time_seconds"] = round(sorted_times[-1], 3)
+            summary["avg_response_time_seconds"] = round(times.total / n, 3)
+            summary["min_response_time_seconds"] = round(times.min, 3)
+            summary["max_response_time_seconds"] = round(times.max, 3)
 
-            # Median
-            if n % 2 == 0:
-                median = (sorted_times[n // 2 - 1] + sorted_times[n // 2]) / 2
-            else:
-                median = sorted_times[n // 2]
+            # Median and percentiles, all by nearest rank in one walk
+            median, p95, p99 = times.percentiles([50, 95, 99])
             summary["median_response_time_seconds"] = round(median, 3)
-
-            # Percentiles
-            p95_idx = int(n * 0.95)
-            p99_idx = int(n * 0.99)
-            summary["p95_response_time_seconds"] = round(sorted_times[p95_idx], 3)
-            summary["p99_response_time_seconds"] = round(sorted_times[p99_idx], 3)
+            summary["p95_response_time_seconds"] = round(p95, 3)
+            summary["p99_response_time_seconds"] = round(p99, 3)
 
             # Requests per second
             if total_time > 0:
@@ -140,7 +279,8 @@ class StressTestStats:
                     self.successful_requests / total_time, 2
                 )
 
-        return summary
+        self._cached_summary = (self.total_requests, self.end_time, summary)
+        return dict(summary)
 
     def print_summary(self):
         """Print summary statistics."""
@@ -172,56 +312,155 @@ class StressTestStats:
         print("=" * 60 + "\n")
 
 
+class AdmissionController:
+    """
+    Cap on requests in flight that can be resized while the test runs.
+
+    Waiters re-check the limit whenever they are woken, so raising or
+    lowering it takes effect immediately, unlike with a Semaphore.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._wakeup: asyncio.Task | None = None
+
+    async def acquire(self):
+        """Wait until a request may start."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        """Mark a request as finished and admit the next waiter."""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify(1)
+
+    def resize(self, limit: int):
+        """Change the limit. Safe to call from sync code like signal handlers."""
+        self.limit = max(1, limit)
+        self._wakeup = asyncio.ensure_future(self._notify_all())
+
+    async def _notify_all(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+
 async def send_compile_request(
     session: aiohttp.ClientSession,
     url: str,
-    code: str,
-    stats: StressTestStats,
+    body: bytes,
     request_id: int,
     timeout: int = 60,
-) -> None:
+) -> Tuple[Outcome, float]:
     """
     Send a single compile request.
 
     Args:
         session: aiohttp session
         url: Compile endpoint URL
-        code: Facto source code
-        stats: Stats tracker
+        body: Pre-serialized JSON request body
         request_id: Request identifier
         timeout: Request timeout in seconds
-    """
-    stats.total_requests += 1
-    start_time = time.time()
 
-    payload = {"source": code, "json_output": False, "log_level": "info"}
+    Returns:
+        (outcome, duration): duration is only meaningful for successes
+    """
+    # Monotonic integer clock: immune to wall-clock jumps, no float math
+    start_ns = time.monotonic_ns()
 
     try:
         async with session.post(
-            url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)
+            url,
+            data=body,
+            headers=JSON_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=timeout),
         ) as response:
-            duration = time.time() - start_time
+            # Drain the body so the connection goes back to the pool; one
+            # left unread when the block exits is closed instead of reused
+            await response.read()
+            duration = (time.monotonic_ns() - start_ns) / 1e9
 
             if response.status == 200:
-                # For streaming endpoint, just check that we got a response
-                stats.record_success(duration)
-                print(f"[{request_id}] ✓ Success ({duration:.2f}s)")
+                # Timed to the end of the body, the same interval the
+                # timeout covers (for /compile, until the compile finishes)
+                return Outcome.SUCCESS, duration
             elif response.status == 429:
-                stats.record_failure("rate_limit")
-                print(f"[{request_id}] ✗ Rate limited")
+                return Outcome.RATE_LIMIT, duration
             else:
-                stats.record_failure("unknown")
-                print(f"[{request_id}] ✗ Failed (HTTP {response.status})")
+                return Outcome.UNKNOWN, duration
 
     except asyncio.TimeoutError:
-        stats.record_failure("timeout")
-        print(f"[{request_id}] ✗ Timeout")
-    except aiohttp.ClientError as e:
-        stats.record_failure("connection")
-        print(f"[{request_id}] ✗ Connection error: {e}")
+        return Outcome.TIMEOUT, 0.0
+    except aiohttp.ClientError:
+        return Outcome.CONNECTION, 0.0
     except Exception as e:
-        stats.record_failure("unknown")
-        print(f"[{request_id}] ✗ Error: {e}")
+        # Unexpected errors always go to stderr, even in quiet mode
+        print(f"[{request_id}] ✗ Error: {e}", file=sys.stderr)
+        return Outcome.UNKNOWN, 0.0
+
+
+async def report_status(stats: StressTestStats, limiter: AdmissionController):
+    """
+    Show progress from one background task instead of a line per request.
+
+    On a terminal the line is redrawn in place ten times a second; otherwise
+    a new line is printed every five seconds. Runs until cancelled.
+    """
+    live = sys.stdout.isatty()
+    interval = 0.1 if live else 5.0
+    # Samples spanning about one second (or one interval) for the rolling rate
+    recent = deque([(time.monotonic(), 0)], maxlen=max(1, round(1 / interval)) + 1)
+
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            done = stats.total_requests
+            recent.append((now, done))
+            then, done_then = recent[0]
+            line = (
+                f"{done} done | {stats.successful_requests} ok | "
+                f"{stats.failed_requests} failed | "
+                f"{limiter.in_flight}/{limiter.limit} in flight | "
+                f"{(done - done_then) / (now - then):.1f} req/s"
+            )
+            # Percentiles refresh every 100 requests rather than every tick
+            p95 = stats.get_summary(max_stale=100).get("p95_response_time_seconds")
+            if p95 is not None:
+                line += f" | p95 {p95}s"
+            if live:
+                print(f"\r{line}\033[K", end="", flush=True)
+            else:
+                print(line, flush=True)
+    finally:
+        if live:
+            print()  # Keep the final status line
+
+
+def print_banner(
+    url: str,
+    total_requests: int,
+    concurrent_requests: int,
+    duration: int = None,
+    use_complex_code: bool = False,
+    workers: int = 1,
+):
+    """Print the parameters of a stress test about to start."""
+    print(f"\nStarting stress test...")
+    print(f"  Target: {url}")
+    print(
+        f"  Total requests: {total_requests if not duration else 'unlimited (duration-based)'}"
+    )
+    print(f"  Concurrent requests: {concurrent_requests}")
+    if workers > 1:
+        print(f"  Worker processes: {workers}")
+    if duration:
+        print(f"  Duration: {duration}s")
+    print(f"  Code complexity: {'complex' if use_complex_code else 'simple'}")
+    print()
 
 
 async def run_stress_test(
@@ -230,6 +469,8 @@ async def run_stress_test(
     concurrent_requests: int,
     duration: int = None,
     use_complex_code: bool = False,
+    quiet: bool = False,
+    banner: bool = True,
 ) -> StressTestStats:
     """
     Run stress test.
@@ -240,63 +481,144 @@ async def run_stress_test(
         concurrent_requests: Number of concurrent requests
         duration: Run for this many seconds (overrides total_requests if set)
         use_complex_code: Use more complex code samples
+        quiet: Do not show the progress line
+        banner: Print the test parameters before starting
 
     Returns:
         StressTestStats object with results
     """
     stats = StressTestStats()
-    stats.start_time = time.time()
+    stats.start_time = time.monotonic()
 
-    print(f"\nStarting stress test...")
-    print(f"  Target: {url}")
-    print(
-        f"  Total requests: {total_requests if not duration else 'unlimited (duration-based)'}"
-    )
-    print(f"  Concurrent requests: {concurrent_requests}")
-    if duration:
-        print(f"  Duration: {duration}s")
-    print(f"  Code complexity: {'complex' if use_complex_code else 'simple'}")
-    print()
+    if banner:
+        print_banner(
+            url, total_requests, concurrent_requests, duration, use_complex_code
+        )
 
     code = COMPLEX_FACTO_CODE if use_complex_code else SAMPLE_FACTO_CODE
 
-    async with aiohttp.ClientSession() as session:
-        if duration:
-            # Duration-based test
-            end_time = time.time() + duration
-            request_id = 0
+    # Every request sends the same payload, so serialize it only once
+    body = json.dumps(
+        {"source": code, "json_output": False, "log_level": "info"}
+    ).encode("utf-8")
 
-            while time.time() < end_time:
-                tasks = []
-                batch_size = min(concurrent_requests, 100)  # Limit batch size
+    # One pooled connector whose connections are kept alive and reused. It is
+    # not capped itself; the admission controller limits requests in flight.
+    # The target host is resolved once per run rather than every 10s default.
+    connector = aiohttp.TCPConnector(
+        limit=0, keepalive_timeout=75, ttl_dns_cache=3600
+    )
 
-                for _ in range(batch_size):
-                    request_id += 1
-                    task = send_compile_request(session, url, code, stats, request_id)
-                    tasks.append(task)
+    limiter = AdmissionController(concurrent_requests)
 
-                await asyncio.gather(*tasks)
+    def resize(factor: float):
+        limiter.resize(int(limiter.limit * factor))
+        # Clear a live status line first so the message gets its own line
+        clear = "\r\033[K" if sys.stdout.isatty() else ""
+        print(f"{clear}Concurrency limit now {limiter.limit}")
 
-                # Brief pause between batches
-                await asyncio.sleep(0.1)
-        else:
-            # Request count-based test
-            tasks = []
+    # SIGUSR1 doubles and SIGUSR2 halves the concurrency of a running test
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, resize, 2)
+        loop.add_signal_handler(signal.SIGUSR2, resize, 0.5)
+    except (AttributeError, NotImplementedError):
+        pass  # No SIGUSR1/SIGUSR2 on this platform
+
+    status_task = (
+        None if quiet else asyncio.create_task(report_status(stats, limiter))
+    )
+
+    async with aiohttp.ClientSession(
+        connector=connector, skip_auto_headers=SKIP_AUTO_HEADERS
+    ) as session:
+
+        async def admitted_request(request_id: int):
+            try:
+                outcome, elapsed = await send_compile_request(
+                    session, url, body, request_id
+                )
+            finally:
+                await limiter.release()
+            # The only place results reach the shared stats
+            stats.record(outcome, elapsed)
+
+        # Start a request whenever the limiter admits one, until the deadline
+        # passes (duration mode) or every request has been sent
+        end_time = time.monotonic() + duration if duration else None
+        in_flight: set[asyncio.Task] = set()
+
+        for request_id in itertools.count(1):
+            if end_time is None and request_id > total_requests:
+                break
+            await limiter.acquire()
+            if end_time is not None and time.monotonic() >= end_time:
+                await limiter.release()
+                break
+            task = asyncio.create_task(admitted_request(request_id))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        await asyncio.gather(*in_flight)
+
+    if status_task is not None:
+        status_task.cancel()
+        await asyncio.gather(status_task, return_exceptions=True)
+
+    stats.end_time = time.monotonic()
+    return stats
 
-            for i in range(1, total_requests + 1):
-                task = send_compile_request(session, url, code, stats, i)
-                tasks.append(task)
 
-                # Execute in batches to respect concurrency limit
-                if len(tasks) >= concurrent_requests or i == total_requests:
-                    await asyncio.gather(*tasks)
-                    tasks = []
+def _split(total: int, parts: int) -> List[int]:
+    """Split total into parts shares that differ by at most one."""
+    return [total // parts + (i < total % parts) for i in range(parts)]
 
-                    # Brief pause between batches
-                    if i < total_requests:
-                        await asyncio.sleep(0.1)
 
-    stats.end_time = time.time()
+def _run_worker(kwargs: Dict[str, Any]) -> StressTestStats:
+    """Run one worker's share of a multi-process test in its own event loop."""
+    run = uvloop.run if uvloop is not None else asyncio.run
+    return run(run_stress_test(**kwargs, quiet=True, banner=False))
+
+
+def run_workers(
+    workers: int,
+    url: str,
+    total_requests: int,
+    concurrent_requests: int,
+    duration: int = None,
+    use_complex_code: bool = False,
+) -> StressTestStats:
+    """
+    Run a stress test split across worker processes.
+
+    One event loop tops out at a few thousand requests per second, so each
+    worker runs an independent loop with its share of the requests and
+    concurrency. The workers' stats are merged into one result.
+    """
+    # Every worker needs at least one request in flight
+    workers = min(workers, concurrent_requests)
+    print_banner(
+        url, total_requests, concurrent_requests, duration, use_complex_code, workers
+    )
+    jobs = [
+        dict(
+            url=url,
+            total_requests=requests,
+            concurrent_requests=concurrent,
+            duration=duration,
+            use_complex_code=use_complex_code,
+        )
+        for requests, concurrent in zip(
+            _split(total_requests, workers), _split(concurrent_requests, workers)
+        )
+    ]
+
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(_run_worker, jobs)
+
+    stats = StressTestStats()
+    for result in results:
+        stats.merge(result)
     return stats
 
 
@@ -333,19 +655,43 @@ def main():
         default=60,
         help="Request timeout in seconds (default: 60)",
     )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only print the summary, not the live progress line",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Split the load across this many processes (default: 1)",
+    )
 
     args = parser.parse_args()
 
-    # Run stress test
-    stats = asyncio.run(
-        run_stress_test(
+    # Run stress test, on uvloop when available so the tester itself is less
+    # likely to become the bottleneck (each worker process does the same)
+    if args.workers > 1:
+        stats = run_workers(
+            workers=args.workers,
             url=args.url,
             total_requests=args.requests,
             concurrent_requests=args.concurrent,
             duration=args.duration,
             use_complex_code=args.complex,
         )
-    )
+    else:
+        run = uvloop.run if uvloop is not None else asyncio.run
+        stats = run(
+            run_stress_test(
+                url=args.url,
+                total_requests=args.requests,
+                concurrent_requests=args.concurrent,
+                duration=args.duration,
+                use_complex_code=args.complex,
+                quiet=args.quiet,
+            )
+        )
 
     # Print results
     stats.print_summary()